@@ -1,15 +1,28 @@
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, HTTPException, Response
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 from typing import List, Dict
 import uvicorn
 import argparse
+import asyncio
+import functools
 import os
-from reranker import get_reranker, rank_documents, unload_reranker
+from reranker import (
+    is_reranker_loaded,
+    rank_documents,
+    unload_reranker,
+    build_pairs,
+    score_pairs,
+    select_top_k,
+    warmup_reranker
+)
+from batcher import DynamicBatcher
 import torch
 from __version__ import __version__
 import logging
+import orjson
 import sys
+import time
 
 # Set CUDA device if specified in environment
 if torch.cuda.is_available():
@@ -24,7 +37,28 @@ if torch.cuda.is_available():
         except ValueError:
             print(f"Warning: Invalid CUDA_DEVICE value '{cuda_device}'. Using default device.")
 
-app = FastAPI(title="Document Reranking API", version=__version__)
+app = FastAPI(
+    title="Document Reranking API",
+    version=__version__,
+    default_response_class=ORJSONResponse
+)
+
+# Coalesces pairs from concurrent /rank requests into shared reranker calls
+batcher = DynamicBatcher(score_pairs)
+
+@app.on_event("startup")
+async def start_batcher():
+    batcher.start()
+
+@app.on_event("startup")
+async def preload_reranker():
+    """Load and warm up the model so the first request doesn't pay for it"""
+    if os.environ.get('RERANKER_WARMUP', 'true') == 'true':
+        await asyncio.to_thread(warmup_reranker)
+
+@app.on_event("shutdown")
+async def stop_batcher():
+    await batcher.stop()
 
 # Add API usage instructions
 API_INSTRUCTIONS: Dict = {
@@ -72,32 +106,55 @@ API_INSTRUCTIONS: Dict = {
     }
 }
 
+# The instructions never change, so they are serialized once at import
+API_INSTRUCTIONS_BYTES = orjson.dumps(API_INSTRUCTIONS)
+
 @app.get("/")
 async def root():
-    return JSONResponse(content=API_INSTRUCTIONS)
+    return Response(content=API_INSTRUCTIONS_BYTES, media_type="application/json")
+
+# How long a /healthz GPU memory reading is reused, in seconds
+MEMORY_INFO_TTL = 1.0
+memory_allocated = None
+memory_read_at = float('-inf')
+
+@functools.lru_cache(maxsize=1)
+def static_gpu_info() -> Dict:
+    """GPU details that don't change while the server runs"""
+    gpu_available = torch.cuda.is_available()
+    return {
+        "gpu_available": gpu_available,
+        "gpu_count": torch.cuda.device_count() if gpu_available else 0,
+        "current_device": torch.cuda.get_device_name() if gpu_available else None,
+        "current_device_id": torch.cuda.current_device() if gpu_available else None,
+        "selected_device": os.environ.get('CUDA_DEVICE', 'default')
+    }
+
+def get_memory_allocated():
+    """Allocated GPU memory, queried from the driver at most once per MEMORY_INFO_TTL"""
+    global memory_allocated, memory_read_at
+    if not torch.cuda.is_available():
+        return None
+    now = time.monotonic()
+    if now - memory_read_at >= MEMORY_INFO_TTL:
+        memory_allocated = f"{torch.cuda.memory_allocated() / 1024**2:.2f}MB"
+        memory_read_at = now
+    return memory_allocated
 
 @app.get("/healthz")
 async def health_check():
     """Health check endpoint that verifies server and model status"""
     try:
-        # Check if model is loaded/can be loaded
-        reranker = get_reranker()
-        model_loaded = reranker is not None
-        
-        # Get GPU information
+        # Report whether the model is loaded without loading it on a probe
         gpu_info = {
-            "gpu_available": torch.cuda.is_available(),
-            "gpu_count": torch.cuda.device_count() if torch.cuda.is_available() else 0,
-            "current_device": torch.cuda.get_device_name() if torch.cuda.is_available() else None,
-            "current_device_id": torch.cuda.current_device() if torch.cuda.is_available() else None,
-            "selected_device": os.environ.get('CUDA_DEVICE', 'default'),
-            "memory_allocated": f"{torch.cuda.memory_allocated() / 1024**2:.2f}MB" if torch.cuda.is_available() else None
+            **static_gpu_info(),
+            "memory_allocated": get_memory_allocated()
         }
         
         return {
             "status": "healthy",
             "model_status": {
-                "loaded": model_loaded,
+                "loaded": is_reranker_loaded(),
                 "type": "BAAI/bge-reranker-v2-gemma"
             },
             "gpu_info": gpu_info
@@ -119,7 +176,8 @@ async def test_reranking():
             "Pandas eat bamboo as their main food source."
         ]
         
-        ranked_docs, execution_time = rank_documents(
+        ranked_docs, execution_time = await asyncio.to_thread(
+            rank_documents,
             question=test_question,
             documents=test_documents,
             top_k=3
@@ -155,7 +213,9 @@ class RankingResponse(BaseModel):
     ranked_documents: List[RankedDocument]
     execution_time: float
 
-@app.post("/rank", response_model=RankingResponse)
+# The response is built from plain dicts, so RankingResponse only documents
+# the schema instead of validating every ranked document again
+@app.post("/rank", responses={200: {"model": RankingResponse}})
 async def rank_documents_endpoint(request: RankingRequest):
     if not request.documents:
         raise HTTPException(status_code=400, detail="No documents provided")
@@ -164,27 +224,24 @@ async def rank_documents_endpoint(request: RankingRequest):
     if request.top_k > len(request.documents):
         request.top_k = len(request.documents)
     
-    ranked_docs, execution_time = rank_documents(
-        question=request.question,
-        documents=request.documents,
-        top_k=request.top_k
-    )
+    start_time = time.time()
+    logging.info(f"Ranking {len(request.documents)} documents")
+    pairs = build_pairs(request.question, request.documents)
+    scores = await batcher.submit(pairs)
+    ranked_docs = select_top_k(request.documents, scores, request.top_k)
+    execution_time = time.time() - start_time
     
-    # Convert RankedDocument objects to dictionaries
-    ranked_docs_dicts = [
-        {"document": doc.document, "score": doc.score}
-        for doc in ranked_docs
-    ]
-    
-    return RankingResponse(
-        ranked_documents=ranked_docs_dicts,
-        execution_time=execution_time
-    )
+    # Returning the response directly skips FastAPI's jsonable_encoder pass,
+    # leaving orjson to encode the ranked documents in one go
+    return ORJSONResponse(content={
+        "ranked_documents": ranked_docs,
+        "execution_time": execution_time
+    })
 
 @app.get("/unload")
 async def unload_model():
     """Unload the model from GPU memory"""
-    unload_reranker()
+    await asyncio.to_thread(unload_reranker)
     return {"status": "success", "message": "Model unloaded from memory"}
 
 def get_args():
@@ -196,6 +253,10 @@ def get_args():
                       type=int,
                       default=int(os.environ.get('RERANK_PORT', '8000')),
                       help='Port to run the server on (default: 8000)')
+    parser.add_argument('--workers',
+                      type=int,
+                      default=int(os.environ.get('RERANK_WORKERS', '1')),
+                      help='Number of worker processes, each loading its own model (default: 1)')
     return parser.parse_args()
 
 # Add after imports
@@ -209,13 +270,19 @@ logging.basicConfig(
 if __name__ == "__main__":
     args = get_args()
     try:
-        logging.info(f"Starting server on {args.host}:{args.port}")
+        logging.info(f"Starting server on {args.host}:{args.port} with {args.workers} worker(s)")
         logging.info(f"CUDA available: {torch.cuda.is_available()}")
         if torch.cuda.is_available():
             logging.info(f"CUDA devices: {torch.cuda.device_count()}")
             logging.info(f"Current CUDA device: {torch.cuda.current_device()}")
             logging.info(f"Device name: {torch.cuda.get_device_name()}")
-        uvicorn.run(app, host=args.host, port=args.port)
+        # Worker processes import the app themselves, so it's passed by name
+        uvicorn.run(
+            "api:app" if args.workers > 1 else app,
+            host=args.host,
+            port=args.port,
+            workers=args.workers
+        )
     except Exception as e:
         logging.error(f"Server failed to start: {str(e)}", exc_info=True)
         sys.exit(1) 
\ No newline at end of file
@@ -0,0 +1,118 @@
+import asyncio
+import logging
+import os
+from typing import Callable, List, Optional, Sequence, Tuple
+
+# Maximum number of pairs coalesced into a single scoring call
+MAX_BATCH_SIZE = int(os.environ.get('RERANKER_MAX_BATCH_SIZE', '8'))
+# Maximum time to wait for more requests before scoring a partial batch
+MAX_LATENCY_MS = float(os.environ.get('RERANKER_MAX_LATENCY_MS', '10'))
+
+class DynamicBatcher:
+    """
+    Coalesces (question, document) pairs from concurrent requests into a
+    single call to the scoring function.
+
+    Requests are queued together with a future. A background task takes the
+    first queued request, then keeps collecting requests until either
+    max_batch_size pairs are queued or max_latency_ms has elapsed, scores all
+    pairs at once and hands each request back its slice of the scores.
+    """
+
+    def __init__(
+        self,
+        score_fn: Callable[[List[List[str]]], Sequence[float]],
+        max_batch_size: int = MAX_BATCH_SIZE,
+        max_latency_ms: float = MAX_LATENCY_MS
+    ):
+        self.score_fn = score_fn
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def start(self):
+        """Start the background batching task on the running event loop"""
+        loop = asyncio.get_running_loop()
+        if self._task is not None and not self._task.done() and self._loop is loop:
+            return
+        self._loop = loop
+        self._queue = asyncio.Queue()
+        self._task = loop.create_task(self._run())
+
+    async def stop(self):
+        """Stop the background batching task"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def submit(self, pairs: List[List[str]]) -> Sequence[float]:
+        """Queue pairs for scoring and wait for their scores"""
+        # Started lazily as well, so the batcher also works without startup events
+        self.start()
+        future = self._loop.create_future()
+        self._queue.put_nowait((pairs, future))
+        return await future
+
+    async def _collect(self) -> List[Tuple[List[List[str]], asyncio.Future]]:
+        """Wait for the next batch of queued requests"""
+        items = [await self._queue.get()]
+        size = len(items[0][0])
+        deadline = self._loop.time() + self.max_latency
+        while size < self.max_batch_size:
+            timeout = deadline - self._loop.time()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            items.append(item)
+            size += len(item[0])
+        return items
+
+    async def _run(self):
+        while True:
+            items = await self._collect()
+            # Skip requests whose client has already gone away
+            items = [(pairs, future) for pairs, future in items if not future.done()]
+            if not items:
+                continue
+
+            all_pairs = [pair for pairs, _ in items for pair in pairs]
+            logging.info(f"Scoring batch of {len(all_pairs)} pairs from {len(items)} requests")
+            try:
+                # Score off the event loop so new requests can queue meanwhile
+                scores = await asyncio.to_thread(self.score_fn, all_pairs)
+            except Exception as e:
+                logging.error(f"Error scoring batch: {str(e)}", exc_info=True)
+                if len(items) == 1:
+                    if not items[0][1].done():
+                        items[0][1].set_exception(e)
+                    continue
+                # Retry each request on its own, so one bad request (e.g. one
+                # large enough to run out of memory) does not fail the others
+                for pairs, future in items:
+                    try:
+                        result = await asyncio.to_thread(self.score_fn, pairs)
+                    except Exception as request_error:
+                        if not future.done():
+                            future.set_exception(request_error)
+                    else:
+                        if not future.done():
+                            future.set_result(result)
+                continue
+
+            # Hand each request back its slice of the scores
+            start = 0
+            for pairs, future in items:
+                end = start + len(pairs)
+                if not future.done():
+                    future.set_result(scores[start:end])
+                start = end
@@ -1,12 +1,23 @@
+import os
+# Let the CUDA caching allocator grow segments in place instead of fragmenting
+# across varying batch shapes. Must be set before torch initializes CUDA.
+os.environ.setdefault('PYTORCH_CUDA_ALLOC_CONF', 'expandable_segments:True')
+
 from FlagEmbedding import FlagLLMReranker
+from transformers import AutoModelForCausalLM, BitsAndBytesConfig
+from score_cache import ScoreCache
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import functools
 import time
-from typing import List, Tuple
+from typing import Dict, List, Sequence, Tuple
 from pydantic import BaseModel
+import numpy as np
 import torch
 import gc
-import os
 import logging
 import sys
+import threading
 
 # Add at top of file after imports
 logging.basicConfig(
@@ -15,68 +26,450 @@ logging.basicConfig(
     stream=sys.stdout
 )
 
+# Allow TF32 tensor cores for any float32 matmuls
+torch.set_float32_matmul_precision('high')
+
 # Create a global reranker instance that can be reused
 global_reranker = None
+# CUDA memory pool holding the model weights, apart from per-request activations
+model_pool = None
+# Guards loading and unloading the global reranker
+reranker_lock = threading.Lock()
+
+# Documents are cut to this many characters before tokenization
+MAX_DOC_CHARS = int(os.environ.get('RERANKER_MAX_DOC_CHARS', '2000'))
+# Maximum number of tokens the tokenizer keeps per document
+MAX_LENGTH = int(os.environ.get('RERANKER_MAX_LENGTH', '512'))
+# Number of threads tokenizing pairs in parallel
+TOKENIZER_WORKERS = int(os.environ.get('RERANKER_TOKENIZER_WORKERS', str(os.cpu_count() or 1)))
+# Number of pairs per model forward
+BATCH_SIZE = int(os.environ.get('RERANKER_BATCH_SIZE', '16'))
+# Maximum number of pairs encoded and scored together
+CHUNK_SIZE = int(os.environ.get('RERANKER_CHUNK_SIZE', '128'))
+# Maximum number of cached pair scores, 0 disables the cache
+SCORE_CACHE_SIZE = int(os.environ.get('RERANKER_SCORE_CACHE_SIZE', '100000'))
+# Weight quantization: none, int8 or int4
+QUANT = os.environ.get('RERANKER_QUANT', 'none').lower()
+# torch.compile mode for the model forward, or none to run eagerly
+COMPILE_MODE = os.environ.get('RERANKER_COMPILE', 'none').lower()
+COMPILE_MODES = ('none', 'default', 'reduce-overhead', 'max-autotune', 'max-autotune-no-cudagraphs')
+
+# HuggingFace fast tokenizers release the GIL while encoding, so shards
+# tokenize concurrently on these threads
+tokenizer_pool = ThreadPoolExecutor(
+    max_workers=TOKENIZER_WORKERS,
+    thread_name_prefix='tokenizer'
+)
+# Each encode call is already parallel in Rust, so tiny shards only add overhead
+MIN_TOKENIZER_SHARD_SIZE = 32
+
+# Scores of recently ranked pairs, so repeat requests skip the model
+score_cache = ScoreCache(SCORE_CACHE_SIZE)
+
+# Same prompt FlagLLMReranker appends to every pair
+DEFAULT_PROMPT = (
+    "Given a query A and a passage B, determine whether the passage contains "
+    "an answer to the query by providing a prediction of either 'Yes' or 'No'."
+)
 
 class RankedDocument(BaseModel):
     document: str
     score: float
 
+def _load_reranker():
+    global global_reranker, model_pool
+    try:
+        logging.info("Initializing reranker...")
+        if QUANT not in ('none', 'int8', 'int4'):
+            raise ValueError(f"Invalid RERANKER_QUANT value '{QUANT}'. Expected none, int8 or int4")
+        if COMPILE_MODE not in COMPILE_MODES:
+            raise ValueError(
+                f"Invalid RERANKER_COMPILE value '{COMPILE_MODE}'. Expected {', '.join(COMPILE_MODES)}"
+            )
+        # Add detailed CUDA diagnostics
+        if (os.environ.get('RERANKER_DEBUG') == 'true'):
+            logging.info(f"PyTorch version: {torch.__version__}")
+            logging.info(f"CUDA available: {torch.cuda.is_available()}")
+            logging.info(f"CUDA version: {torch.version.cuda if torch.cuda.is_available() else 'N/A'}")
+            logging.info(f"CUDA device count: {torch.cuda.device_count()}")
+            logging.info(f"Current CUDA device: {torch.cuda.current_device()}")
+            logging.info(f"CUDA device name: {torch.cuda.get_device_name(0)}")
+        
+        # Get selected CUDA device
+        device = None
+        if torch.cuda.is_available():
+            cuda_device = os.environ.get('CUDA_DEVICE')
+            if cuda_device is not None:
+                try:
+                    device_id = int(cuda_device)
+                    if device_id >= 0 and device_id < torch.cuda.device_count():
+                        device = f'cuda:{device_id}'
+                        logging.info(f"Using specified CUDA device: {device}")
+                except ValueError:
+                    logging.warning(f"Invalid CUDA_DEVICE value: {cuda_device}")
+            if device is None:
+                device = 'cuda:0'
+                logging.info("Using default CUDA device: cuda:0")
+        else:
+            device = 'cpu'
+            logging.info("CUDA not available, using CPU")
+
+        # Fail on an unusable setting before downloading and loading the model
+        if QUANT == 'int4' and device == 'cpu':
+            raise ValueError("int4 quantization requires a CUDA device")
+
+        logging.info(f"Loading model on device: {device}")
+        model_name = os.environ.get('RERANKER_MODEL', 'BAAI/bge-reranker-v2-gemma')
+        reranker = FlagLLMReranker(
+            model_name,
+            use_fp16=True,
+            cache_dir='./model_cache',
+            device=device
+        )
+        # Allocate the weights from their own pool so unloading frees whole
+        # segments instead of leaving holes between activation blocks
+        pool = None
+        pool_context = contextlib.nullcontext()
+        if device != 'cpu' and hasattr(torch.cuda, 'MemPool'):
+            pool = torch.cuda.MemPool()
+            pool_context = torch.cuda.use_mem_pool(pool, device=device)
+        
+        # Scoring runs the model directly instead of through compute_score,
+        # so place it on its device once here
+        with pool_context:
+            if QUANT == 'none':
+                dtype = torch.float16 if device != 'cpu' else torch.float32
+                reranker.model.to(device=device, dtype=dtype)
+            else:
+                quantize_model(reranker, model_name, device)
+        reranker.model.eval()
+        if COMPILE_MODE != 'none':
+            # Fuses the transformer kernels; compilation itself happens on the first forward.
+            # Scoring calls the decoder directly, so that is what gets compiled.
+            logging.info(f"Compiling model with mode: {COMPILE_MODE}")
+            model = reranker.model
+            model.set_decoder(torch.compile(
+                model.get_decoder(),
+                mode=COMPILE_MODE,
+                fullgraph=False
+            ))
+        # Publish only once fully prepared, since get_reranker reads it unlocked.
+        # The pool is published alongside so a failed load never leaves it behind.
+        model_pool = pool
+        global_reranker = reranker
+        logging.info("Reranker initialized successfully")
+    except Exception as e:
+        logging.error(f"Error initializing reranker: {str(e)}", exc_info=True)
+        raise
+
 def get_reranker():
-    global global_reranker
     if global_reranker is None:
-        try:
-            logging.info("Initializing reranker...")
-            # Add detailed CUDA diagnostics
-            if (os.environ.get('RERANKER_DEBUG') == 'true'):
-                logging.info(f"PyTorch version: {torch.__version__}")
-                logging.info(f"CUDA available: {torch.cuda.is_available()}")
-                logging.info(f"CUDA version: {torch.version.cuda if torch.cuda.is_available() else 'N/A'}")
-                logging.info(f"CUDA device count: {torch.cuda.device_count()}")
-                logging.info(f"Current CUDA device: {torch.cuda.current_device()}")
-                logging.info(f"CUDA device name: {torch.cuda.get_device_name(0)}")
-            
-            # Get selected CUDA device
-            device = None
-            if torch.cuda.is_available():
-                cuda_device = os.environ.get('CUDA_DEVICE')
-                if cuda_device is not None:
-                    try:
-                        device_id = int(cuda_device)
-                        if device_id >= 0 and device_id < torch.cuda.device_count():
-                            device = f'cuda:{device_id}'
-                            logging.info(f"Using specified CUDA device: {device}")
-                    except ValueError:
-                        logging.warning(f"Invalid CUDA_DEVICE value: {cuda_device}")
-                if device is None:
-                    device = 'cuda:0'
-                    logging.info("Using default CUDA device: cuda:0")
-            else:
-                device = 'cpu'
-                logging.info("CUDA not available, using CPU")
-
-            logging.info(f"Loading model on device: {device}")
-            global_reranker = FlagLLMReranker(
-                os.environ.get('RERANKER_MODEL', 'BAAI/bge-reranker-v2-gemma'),
-                use_fp16=True,
-                cache_dir='./model_cache',
-                device=device
-            )
-            logging.info("Reranker initialized successfully")
-        except Exception as e:
-            logging.error(f"Error initializing reranker: {str(e)}", exc_info=True)
-            raise
+        # Requests reach this from several threads; only one of them loads the model
+        with reranker_lock:
+            if global_reranker is None:
+                _load_reranker()
     return global_reranker
 
+def is_reranker_loaded() -> bool:
+    """Whether the reranker model is currently loaded, without loading it"""
+    return global_reranker is not None
+
+def quantize_model(reranker, model_name: str, device: str):
+    """
+    Quantize the reranker's causal LM in place according to RERANKER_QUANT.
+    
+    On CPU, int8 applies PyTorch dynamic quantization to the linear layers.
+    On CUDA, the weights are reloaded in int8 or int4 through bitsandbytes,
+    which must be installed separately.
+    
+    Args:
+        reranker: The FlagLLMReranker whose full precision model is replaced
+        model_name: Name or path of the model, used to reload it quantized
+        device: Device the model runs on
+    """
+    logging.info(f"Quantizing model to {QUANT}")
+    
+    if device == 'cpu':
+        # The model is already float32; quantize in place rather than on a copy
+        reranker.model = torch.ao.quantization.quantize_dynamic(
+            reranker.model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+        )
+        return
+    
+    if QUANT == 'int4':
+        quantization_config = BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_compute_dtype=torch.float16
+        )
+    else:
+        quantization_config = BitsAndBytesConfig(load_in_8bit=True)
+    # Free the full precision model before loading the quantized copy
+    reranker.model = None
+    gc.collect()
+    reranker.model = AutoModelForCausalLM.from_pretrained(
+        model_name,
+        cache_dir='./model_cache',
+        quantization_config=quantization_config,
+        torch_dtype=torch.float16,
+        device_map={'': device}
+    )
+
+def warmup_reranker():
+    """Load the reranker and run a throwaway forward so kernels are ready for requests"""
+    start_time = time.time()
+    reranker = get_reranker()
+    forward_scores(reranker, encode_pairs(reranker, [["warm", "up"]] * 4))
+    logging.info(f"Reranker warmed up in {time.time() - start_time:.2f} seconds")
+
 def unload_reranker():
-    """Unload the reranker model and clear GPU memory"""
-    global global_reranker
-    if global_reranker is not None:
+    """
+    Unload the reranker model and clear GPU memory.
+    
+    This is the only place the CUDA cache is released; ranking calls keep the
+    cached blocks so later requests reuse them without going back to cudaMalloc.
+    """
+    global global_reranker, model_pool
+    with reranker_lock:
+        if global_reranker is None:
+            return
         del global_reranker
         global_reranker = None
+        # Drop cached token ids along with the tokenizer they came from
+        cached_ids.cache_clear()
+        gc.collect()
+        # With the weights gone the pool is empty and its segments can be released
+        model_pool = None
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
-        gc.collect()
+
+def build_pairs(question: str, documents: List[str]) -> List[List[str]]:
+    """Build the (question, document) pairs passed to the reranker"""
+    # Truncate long documents up front so tokenization doesn't starve the GPU
+    return [[question, doc[:MAX_DOC_CHARS]] for doc in documents]
+
+def _tokenize(tokenizer, texts: List[str]) -> List[List[int]]:
+    # No truncation or padding here: changing either reconfigures the shared
+    # Rust tokenizer, which is not safe while other threads are encoding
+    return tokenizer(texts, add_special_tokens=False)['input_ids']
+
+@functools.lru_cache(maxsize=1024)
+def cached_ids(tokenizer, text: str) -> Tuple[int, ...]:
+    """Tokenize a text that recurs across pairs and requests, such as a question"""
+    return tuple(_tokenize(tokenizer, [text])[0])
+
+def tokenize_parallel(reranker, texts: List[str]) -> List[List[int]]:
+    """Tokenize texts in shards across the tokenizer thread pool"""
+    shard_size = max(MIN_TOKENIZER_SHARD_SIZE, -(-len(texts) // TOKENIZER_WORKERS))
+    shards = [texts[i:i + shard_size] for i in range(0, len(texts), shard_size)]
+    if len(shards) == 1:
+        return _tokenize(reranker.tokenizer, texts)
+    results = tokenizer_pool.map(lambda shard: _tokenize(reranker.tokenizer, shard), shards)
+    return [ids for shard in results for ids in shard]
+
+def encode_pairs(reranker, pairs: List[List[str]]) -> List[List[int]]:
+    """
+    Tokenize pairs into model inputs, laid out the way FlagLLMReranker does:
+    
+        <bos> A: {question} \n B: {document} \n {prompt}
+    
+    Args:
+        reranker: The loaded FlagLLMReranker
+        pairs: List of [question, document] pairs
+        
+    Returns:
+        List of input ids, one per pair
+    """
+    query_format = getattr(reranker, 'query_instruction_format', None) or '{}{}'
+    query_prefix = getattr(reranker, 'query_instruction_for_rerank', None) or 'A: '
+    passage_format = getattr(reranker, 'passage_instruction_format', None) or '{}{}'
+    passage_prefix = getattr(reranker, 'passage_instruction_for_rerank', None) or 'B: '
+    prompt = getattr(reranker, 'prompt', None) or DEFAULT_PROMPT
+    
+    tokenizer = reranker.tokenizer
+    # The question is shared by every pair of a request, so it is tokenized
+    # once (and reused across requests) instead of once per document
+    query_ids = [
+        cached_ids(tokenizer, query_format.format(query_prefix, question))
+        for question, _ in pairs
+    ]
+    passage_ids = tokenize_parallel(
+        reranker,
+        [passage_format.format(passage_prefix, doc) for _, doc in pairs]
+    )
+    
+    sep_ids = list(cached_ids(tokenizer, '\n'))
+    prompt_ids = list(cached_ids(tokenizer, prompt))
+    query_max_length = MAX_LENGTH * 3 // 4
+    encode_max_length = MAX_LENGTH + len(sep_ids) + len(prompt_ids)
+    
+    # Like FlagLLMReranker, only lead with BOS when the tokenizer has a distinct one
+    bos_ids = []
+    if tokenizer.bos_token_id is not None and tokenizer.bos_token_id != tokenizer.pad_token_id:
+        bos_ids = [tokenizer.bos_token_id]
+    
+    inputs = []
+    for q_ids, p_ids in zip(query_ids, passage_ids):
+        first = bos_ids + list(q_ids[:query_max_length])
+        # Only the document side is cut to fit the encode budget
+        second = (sep_ids + p_ids[:MAX_LENGTH])[:max(encode_max_length - len(first), 0)]
+        inputs.append(first + second + sep_ids + prompt_ids)
+    return inputs
+
+def stage_batch(
+    inputs: List[List[int]],
+    indices: List[int],
+    pad_id: int,
+    device: torch.device,
+    copy_stream=None
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Pad a batch of encoded pairs and move it to the model's device.
+    
+    On CUDA the tensors are pinned and copied on copy_stream without blocking,
+    so the copy overlaps with the forward already running on the compute stream.
+    
+    Returns:
+        Tuple of input ids, attention mask and each pair's last token position
+    """
+    batch = [torch.tensor(inputs[i], dtype=torch.long) for i in indices]
+    lengths = torch.tensor([len(ids) for ids in batch])
+    input_ids = torch.nn.utils.rnn.pad_sequence(batch, batch_first=True, padding_value=pad_id)
+    attention_mask = (torch.arange(input_ids.shape[1])[None, :] < lengths[:, None]).long()
+    tensors = (input_ids, attention_mask, lengths - 1)
+    if copy_stream is None:
+        return tuple(t.to(device) for t in tensors)
+    with torch.cuda.stream(copy_stream):
+        return tuple(t.pin_memory().to(device, non_blocking=True) for t in tensors)
+
+@torch.inference_mode()
+def forward_scores(reranker, inputs: List[List[int]]) -> np.ndarray:
+    """Run the model over encoded pairs and return the 'Yes' logit of each"""
+    tokenizer = reranker.tokenizer
+    model = reranker.model
+    device = model.device
+    decoder = model.get_decoder()
+    lm_head = model.get_output_embeddings()
+    softcap = getattr(model.config, 'final_logit_softcapping', None)
+    yes_loc = cached_ids(tokenizer, 'Yes')[0]
+    pad_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else 0
+    
+    # Bucket pairs of similar length together so batches carry little padding,
+    # longest first so an out of memory error surfaces on the first batch
+    order = np.argsort([-len(ids) for ids in inputs], kind='stable').tolist()
+    batches = [order[i:i + BATCH_SIZE] for i in range(0, len(order), BATCH_SIZE)]
+    
+    copy_stream = None
+    if device.type == 'cuda':
+        copy_stream = torch.cuda.Stream(device)
+        compute_stream = torch.cuda.current_stream(device)
+    
+    sorted_scores = []
+    staged = stage_batch(inputs, batches[0], pad_id, device, copy_stream)
+    for batch_index in range(len(batches)):
+        if copy_stream is not None:
+            # Wait for this batch's copy, and keep its memory alive until
+            # the compute stream is done with it
+            compute_stream.wait_stream(copy_stream)
+            for t in staged:
+                t.record_stream(compute_stream)
+        input_ids, attention_mask, last = staged
+        
+        hidden = decoder(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            use_cache=False
+        ).last_hidden_state
+        # Inputs are right padded, so the score sits at each pair's last real token.
+        # Only those hidden states are projected onto the vocabulary, instead of
+        # materializing logits for every position of every pair.
+        logits = lm_head(hidden[torch.arange(input_ids.shape[0], device=device), last])
+        if softcap is not None:
+            logits = torch.tanh(logits / softcap) * softcap
+        sorted_scores.append(logits[:, yes_loc].float())
+        
+        # Kernels run asynchronously, so the next batch is padded and copied
+        # while this one is still computing
+        if batch_index + 1 < len(batches):
+            staged = stage_batch(inputs, batches[batch_index + 1], pad_id, device, copy_stream)
+    
+    # Copy all scores back in one transfer and restore the original pair order
+    scores = np.empty(len(inputs), dtype=np.float32)
+    scores[order] = torch.cat(sorted_scores).cpu().numpy()
+    return scores
+
+def score_pairs(pairs: List[List[str]]) -> np.ndarray:
+    """
+    Score (question, document) pairs.
+    
+    Pairs scored before are served from the score cache without running the
+    model; the rest are encoded and scored in chunks of CHUNK_SIZE pairs.
+    
+    Args:
+        pairs: List of [question, document] pairs, possibly from several requests
+        
+    Returns:
+        Array of float32 relevance scores, one per pair and in the same order
+    """
+    if score_cache.maxsize <= 0:
+        # Cache disabled: skip hashing every document
+        keys = None
+        scores = np.empty(len(pairs), dtype=np.float32)
+        misses = list(range(len(pairs)))
+    else:
+        keys = score_cache.keys_for(pairs)
+        scores, misses = score_cache.lookup(keys)
+    if not misses:
+        logging.info(f"All {len(pairs)} pair scores served from cache")
+        return scores
+    
+    # The batcher may coalesce identical requests, so score each distinct pair once
+    unique_misses = misses
+    slots = list(range(len(misses)))
+    if keys is not None:
+        slot_by_key = {}
+        unique_misses = []
+        slots = []
+        for i in misses:
+            if keys[i] not in slot_by_key:
+                slot_by_key[keys[i]] = len(unique_misses)
+                unique_misses.append(i)
+            slots.append(slot_by_key[keys[i]])
+    
+    reranker = get_reranker()
+    logging.info(f"Computing scores for {len(unique_misses)} of {len(pairs)} pairs...")
+    miss_pairs = [pairs[i] for i in unique_misses]
+    # Encode and score in chunks so memory stays bounded however many
+    # documents a request carries
+    computed = np.concatenate([
+        forward_scores(reranker, encode_pairs(reranker, miss_pairs[i:i + CHUNK_SIZE]))
+        for i in range(0, len(miss_pairs), CHUNK_SIZE)
+    ])
+    scores[misses] = computed[slots]
+    if keys is not None:
+        score_cache.store([keys[i] for i in unique_misses], computed.tolist())
+    return scores
+
+def select_top_k(
+    documents: List[str],
+    scores: Sequence[float],
+    top_k: int
+) -> List[Dict]:
+    """Select the top_k documents by score as plain document/score dicts"""
+    scores = np.asarray(scores, dtype=np.float32)
+    if top_k == 1:
+        # A single best document needs no sorting at all
+        indices = [int(np.argmax(scores))]
+    elif top_k >= len(documents):
+        # Every document is returned, so a plain descending sort is enough
+        indices = np.argsort(-scores, kind='stable').tolist()
+    else:
+        # Partition out the top_k in linear time, then sort only those
+        top_indices = np.argpartition(-scores, top_k - 1)[:top_k]
+        indices = top_indices[np.argsort(-scores[top_indices], kind='stable')].tolist()
+    return [
+        {"document": documents[i], "score": score}
+        for i, score in zip(indices, scores[indices].tolist())
+    ]
 
 def rank_documents(
     question: str,
@@ -101,21 +494,14 @@ def rank_documents(
     try:
         logging.info(f"Ranking {len(documents)} documents")
         # Prepare pairs for ranking
-        pairs = [[question, doc] for doc in documents]
-        
-        # Get reranker and compute scores
-        reranker = get_reranker()
-        logging.info("Computing scores...")
-        scores = reranker.compute_score(pairs)
-        
-        # Create document-score pairs and sort
-        doc_scores = list(zip(documents, scores))
-        doc_scores.sort(key=lambda x: x[1], reverse=True)
+        pairs = build_pairs(question, documents)
         
-        # Take top_k results and convert to RankedDocument objects
+        # Compute scores and take the top_k documents
+        scores = score_pairs(pairs)
+        # Values are already well typed, so skip pydantic validation
         ranked_documents = [
-            RankedDocument(document=doc, score=float(score))
-            for doc, score in doc_scores[:top_k]
+            RankedDocument.model_construct(**doc)
+            for doc in select_top_k(documents, scores, top_k)
         ]
         
         execution_time = time.time() - start_time
@@ -124,12 +510,4 @@ def rank_documents(
         
     except Exception as e:
         logging.error(f"Error during document ranking: {str(e)}", exc_info=True)
-        raise
-    finally:
-        # Clear CUDA cache after each ranking operation
-        if torch.cuda.is_available():
-            try:
-                torch.cuda.empty_cache()
-                gc.collect()
-            except Exception as e:
-                logging.error(f"Error clearing CUDA cache: {str(e)}")
\ No newline at end of file
+        raise
\ No newline at end of file
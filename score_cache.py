@@ -0,0 +1,76 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import List, Sequence, Tuple
+import numpy as np
+
+ScoreKey = Tuple[bytes, bytes]
+
+def _digest(text: str) -> bytes:
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest()
+
+class ScoreCache:
+    """
+    Thread-safe LRU cache of (question, document) scores.
+
+    Entries are keyed by short blake2b digests of the question and the
+    document, so memory per entry stays constant however long the texts are.
+    A maxsize of 0 disables the cache.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._scores: "OrderedDict[ScoreKey, float]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._scores)
+
+    def keys_for(self, pairs: List[List[str]]) -> List[ScoreKey]:
+        """Build cache keys for pairs, hashing each distinct question once"""
+        question_digests = {}
+        keys = []
+        for question, doc in pairs:
+            if question not in question_digests:
+                question_digests[question] = _digest(question)
+            keys.append((question_digests[question], _digest(doc)))
+        return keys
+
+    def lookup(self, keys: List[ScoreKey]) -> Tuple[np.ndarray, List[int]]:
+        """
+        Look up cached scores.
+
+        Returns:
+            Tuple containing:
+            - Array of scores, only meaningful at the cached positions
+            - Indices of the keys that were not cached
+        """
+        scores = np.zeros(len(keys), dtype=np.float32)
+        if self.maxsize <= 0:
+            return scores, list(range(len(keys)))
+
+        misses = []
+        with self._lock:
+            for i, key in enumerate(keys):
+                score = self._scores.get(key)
+                if score is None:
+                    misses.append(i)
+                else:
+                    self._scores.move_to_end(key)
+                    scores[i] = score
+        return scores, misses
+
+    def store(self, keys: List[ScoreKey], scores: Sequence[float]):
+        """Cache scores, evicting the least recently used entries when full"""
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            for key, score in zip(keys, scores):
+                self._scores[key] = score
+                self._scores.move_to_end(key)
+            while len(self._scores) > self.maxsize:
+                self._scores.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._scores.clear()
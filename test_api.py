@@ -1,7 +1,16 @@
 import pytest
 from fastapi.testclient import TestClient
 from api import app, API_INSTRUCTIONS
-from reranker import rank_documents
+import numpy as np
+from reranker import (
+    rank_documents,
+    select_top_k,
+    score_pairs,
+    get_reranker,
+    MAX_LENGTH,
+    QUANT
+)
+from score_cache import ScoreCache
 from unittest.mock import patch
 
 client = TestClient(app)
@@ -45,6 +54,16 @@ def test_healthz_endpoint():
     assert "selected_device" in gpu_info
     assert "memory_allocated" in gpu_info
 
+def test_healthz_does_not_load_model():
+    """Test the health check reports model status without loading it"""
+    with patch('reranker.global_reranker', None), \
+            patch('reranker._load_reranker') as mock_load:
+        response = client.get("/healthz")
+        
+        assert response.status_code == 200
+        assert response.json()["model_status"]["loaded"] is False
+        mock_load.assert_not_called()
+
 def test_test_endpoint():
     """Test the test endpoint with predefined example"""
     response = client.get("/test")
@@ -146,6 +165,45 @@ def test_reranker_function():
     scores = [doc.score for doc in ranked_docs]
     assert scores == sorted(scores, reverse=True)
 
+def test_score_pairs_matches_flagembedding():
+    """Test our scoring path matches FlagLLMReranker.compute_score"""
+    if QUANT != 'none':
+        pytest.skip("compute_score re-casts the model, which quantized models do not support")
+    reranker = get_reranker()
+    long_document = " ".join(TEST_DOCUMENTS) * 100
+    # No character cap is applied here, so the document side hits the token budget
+    assert len(reranker.tokenizer(long_document)['input_ids']) > MAX_LENGTH
+    pairs = [[TEST_QUESTION, doc] for doc in TEST_DOCUMENTS + [long_document]]
+    
+    # Bypass the score cache so both paths run the model
+    with patch('reranker.score_cache', ScoreCache(0)):
+        scores = score_pairs(pairs)
+    # compute_score sets truncation on the shared tokenizer and may move the
+    # model, so put both back for the tests that run after this one
+    param = next(reranker.model.parameters())
+    device, dtype = param.device, param.dtype
+    try:
+        expected = reranker.compute_score(pairs, max_length=MAX_LENGTH)
+    finally:
+        reranker.tokenizer._tokenizer.no_truncation()
+        reranker.model.to(device=device, dtype=dtype)
+    
+    np.testing.assert_allclose(scores, expected, rtol=1e-2, atol=5e-2)
+
+def test_select_top_k():
+    """Test top_k selection for single, partial and full result sets"""
+    documents = ["a", "b", "c", "d"]
+    scores = [0.5, 2.0, -1.0, 1.0]
+    
+    assert select_top_k(documents, scores, 1) == [{"document": "b", "score": 2.0}]
+    
+    partial = select_top_k(documents, scores, 2)
+    assert [doc["document"] for doc in partial] == ["b", "d"]
+    
+    full = select_top_k(documents, scores, 4)
+    assert [doc["document"] for doc in full] == ["b", "d", "a", "c"]
+    assert [doc["score"] for doc in full] == [2.0, 1.0, 0.5, -1.0]
+
 def test_rank_endpoint_relevance():
     """Test if the ranking makes semantic sense"""
     request_data = {
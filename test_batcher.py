@@ -0,0 +1,89 @@
+import asyncio
+import pytest
+from batcher import DynamicBatcher
+
+def fake_scores(pairs):
+    """Score each pair by the length of its document"""
+    return [float(len(doc)) for _, doc in pairs]
+
+def test_batcher_coalesces_concurrent_requests():
+    """Test concurrent submissions are scored in a single call"""
+    calls = []
+
+    def score_fn(pairs):
+        calls.append(len(pairs))
+        return fake_scores(pairs)
+
+    async def run():
+        batcher = DynamicBatcher(score_fn, max_batch_size=8, max_latency_ms=50)
+        results = await asyncio.gather(
+            batcher.submit([["q1", "a"], ["q1", "bb"]]),
+            batcher.submit([["q2", "ccc"]]),
+            batcher.submit([["q3", "dddd"], ["q3", "e"]])
+        )
+        await batcher.stop()
+        return results
+
+    results = asyncio.run(run())
+    assert calls == [5]
+    assert results == [[1.0, 2.0], [3.0], [4.0, 1.0]]
+
+def test_batcher_respects_max_batch_size():
+    """Test a full batch is scored without waiting for the latency window"""
+    calls = []
+
+    def score_fn(pairs):
+        calls.append(len(pairs))
+        return fake_scores(pairs)
+
+    async def run():
+        batcher = DynamicBatcher(score_fn, max_batch_size=2, max_latency_ms=1000)
+        results = await asyncio.wait_for(
+            asyncio.gather(
+                batcher.submit([["q", "a"], ["q", "bb"]]),
+                batcher.submit([["q", "ccc"], ["q", "dddd"]])
+            ),
+            timeout=0.5
+        )
+        await batcher.stop()
+        return results
+
+    results = asyncio.run(run())
+    assert calls == [2, 2]
+    assert results == [[1.0, 2.0], [3.0, 4.0]]
+
+def test_batcher_propagates_errors():
+    """Test scoring errors are raised to every request in the batch"""
+    def score_fn(pairs):
+        raise RuntimeError("scoring failed")
+
+    async def run():
+        batcher = DynamicBatcher(score_fn, max_batch_size=8, max_latency_ms=10)
+        try:
+            await batcher.submit([["q", "a"]])
+        finally:
+            await batcher.stop()
+
+    with pytest.raises(RuntimeError, match="scoring failed"):
+        asyncio.run(run())
+
+def test_batcher_isolates_failing_request():
+    """Test a failing request does not fail the requests batched with it"""
+    def score_fn(pairs):
+        if any(doc == "boom" for _, doc in pairs):
+            raise RuntimeError("scoring failed")
+        return fake_scores(pairs)
+
+    async def run():
+        batcher = DynamicBatcher(score_fn, max_batch_size=8, max_latency_ms=50)
+        results = await asyncio.gather(
+            batcher.submit([["q1", "a"], ["q1", "bb"]]),
+            batcher.submit([["q2", "boom"]]),
+            return_exceptions=True
+        )
+        await batcher.stop()
+        return results
+
+    good, bad = asyncio.run(run())
+    assert good == [1.0, 2.0]
+    assert isinstance(bad, RuntimeError)
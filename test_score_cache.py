@@ -0,0 +1,48 @@
+from score_cache import ScoreCache
+
+PAIRS = [
+    ["What is a panda?", "The giant panda is a bear native to China."],
+    ["What is a panda?", "Python is a programming language."],
+    ["What is Python?", "Python is a programming language."]
+]
+
+def test_lookup_returns_cached_scores_and_misses():
+    """Test cached pairs are returned and uncached pairs reported as misses"""
+    cache = ScoreCache(maxsize=10)
+    keys = cache.keys_for(PAIRS)
+    cache.store([keys[0], keys[2]], [1.5, -0.5])
+    
+    scores, misses = cache.lookup(keys)
+    assert misses == [1]
+    assert scores[0] == 1.5
+    assert scores[2] == -0.5
+
+def test_keys_depend_on_question_and_document():
+    """Test the same document under different questions gets different keys"""
+    cache = ScoreCache(maxsize=10)
+    keys = cache.keys_for(PAIRS)
+    assert len(set(keys)) == len(PAIRS)
+    assert keys == cache.keys_for(PAIRS)
+
+def test_least_recently_used_entry_is_evicted():
+    """Test the cache evicts the least recently used entry when full"""
+    cache = ScoreCache(maxsize=2)
+    keys = cache.keys_for(PAIRS)
+    cache.store(keys[:2], [1.0, 2.0])
+    # Touch the first entry so the second becomes least recently used
+    cache.lookup([keys[0]])
+    cache.store([keys[2]], [3.0])
+    
+    assert len(cache) == 2
+    _, misses = cache.lookup(keys)
+    assert misses == [1]
+
+def test_zero_maxsize_disables_cache():
+    """Test a cache with maxsize 0 never stores scores"""
+    cache = ScoreCache(maxsize=0)
+    keys = cache.keys_for(PAIRS)
+    cache.store(keys, [1.0, 2.0, 3.0])
+    
+    _, misses = cache.lookup(keys)
+    assert misses == [0, 1, 2]
+    assert len(cache) == 0